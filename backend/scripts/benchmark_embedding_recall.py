@@ -0,0 +1,91 @@
+"""
+Measures recall@K of truncated / quantized embeddings against the full-precision 3072-d baseline.
+
+The corpus is our own chunk table. Each chunk is embedded once at full precision, then every
+(dimensions, dtype) combination is derived locally from that vector, so the benchmark costs one
+embedding call per chunk and per query regardless of how many representations are compared.
+
+Usage (from the backend directory):
+    python -m scripts.benchmark_embedding_recall --max-chunks 1000 --queries questions.txt
+"""
+import argparse
+
+from sqlalchemy import select
+from google.genai.types import EmbedContentConfig
+
+from src import config
+from src.embeddings import CompactEmbedding, SUPPORTED_DTYPES, dot_product, truncate_embedding
+from src.models.chunk import Chunk
+from src.rag_handler import SessionLocal, client, _get_text_embedding, _parse_chunk_metadata
+
+# Vertex AI の embed_content は 1 リクエストあたりの入力数に上限があるため、分割して送る
+EMBED_BATCH_SIZE = 50
+
+
+def _embed_documents(texts: list[str]) -> list[list[float]]:
+    embeddings = []
+    for i in range(0, len(texts), EMBED_BATCH_SIZE):
+        response = client.models.embed_content(
+            model=config.GEMINI_EMBEDDING_MODEL,
+            contents=texts[i:i + EMBED_BATCH_SIZE],
+            config=EmbedContentConfig(
+                task_type="RETRIEVAL_DOCUMENT",
+                output_dimensionality=config.EMBEDDING_DIMENSIONS,
+            ),
+        )
+        embeddings.extend(embedding.values for embedding in response.embeddings)
+    return embeddings
+
+
+def _top_k(query: list[float], corpus: list[list[float]], k: int) -> list[int]:
+    scores = [dot_product(query, doc) for doc in corpus]
+    return sorted(range(len(corpus)), key=scores.__getitem__, reverse=True)[:k]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-chunks', type=int, default=1000)
+    parser.add_argument('--max-queries', type=int, default=100)
+    parser.add_argument('--queries', help='Text file with one question per line. Defaults to the chunk titles.')
+    parser.add_argument('-k', type=int, default=config.K)
+    args = parser.parse_args()
+
+    with SessionLocal() as session:
+        chunks = session.execute(select(Chunk).limit(args.max_chunks)).scalars().all()
+    print(f"Embedding {len(chunks)} chunks...")
+    corpus = _embed_documents([chunk.content for chunk in chunks])
+
+    if args.queries:
+        with open(args.queries, encoding='utf-8') as f:
+            questions = [line.strip() for line in f if line.strip()]
+    else:
+        titles = (_parse_chunk_metadata(chunk)["title"] for chunk in chunks)
+        questions = list(dict.fromkeys(title for title in titles if title))
+    questions = questions[:args.max_queries]
+    print(f"Embedding {len(questions)} queries...")
+    queries = [_get_text_embedding(question) for question in questions]
+
+    baseline = [set(_top_k(query, corpus, args.k)) for query in queries]
+
+    # 検索はどの表現でも float に復元してから Python で行うため、ここでは速度ではなく精度とサイズだけを比較する
+    print()
+    print(f"| dims | dtype   | bytes/vector | corpus size (KiB) | recall@{args.k} |")
+    print("|------|---------|--------------|-------------------|----------|")
+    for dimensions in config.MATRYOSHKA_DIMENSIONS:
+        for dtype in SUPPORTED_DTYPES:
+            compact_corpus = [CompactEmbedding.from_values(doc, dimensions, dtype) for doc in corpus]
+            restored_corpus = [embedding.to_values() for embedding in compact_corpus]
+
+            hits = 0
+            for query, expected in zip(queries, baseline):
+                found = _top_k(truncate_embedding(query, dimensions), restored_corpus, args.k)
+                hits += len(expected.intersection(found))
+
+            recall = hits / (len(queries) * args.k) if queries else 0.0
+            bytes_per_vector = compact_corpus[0].nbytes if compact_corpus else 0
+            corpus_size = sum(embedding.nbytes for embedding in compact_corpus) / 1024
+            print(f"| {dimensions:4d} | {dtype:7s} | {bytes_per_vector:12d} | {corpus_size:17.1f} | {recall:8.3f} |")
+
+
+if __name__ == '__main__':
+    main()
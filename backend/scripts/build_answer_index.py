@@ -0,0 +1,233 @@
+"""
+Builds the offline answer index for the most frequent questions. Run it off-peak, e.g. from cron.
+
+1. Reads the question log written by the websocket endpoint (logs/queries.log and its rotations).
+2. Detects the language of each distinct question with the HyDE call (cached in <output>.languages.json).
+3. Clusters near-identical questions of the same language by embedding similarity, most frequent first.
+4. Answers the top clusters with handle_retrieval + get_stream, exactly as the live path would.
+5. Saves answers, sources and languages to config.ANSWER_INDEX_PATH, keyed by question embedding.
+
+An existing answer is reused without any Gemini call as long as the `scraped_at` of every chunk
+it was built from is unchanged. With --refresh-only, the question log is not read and only the
+existing entries whose chunks were re-scraped are regenerated.
+
+Usage (from the backend directory):
+    python -m scripts.build_answer_index --top 300
+    python -m scripts.build_answer_index --refresh-only
+"""
+import os
+import glob
+import json
+import time
+import argparse
+import datetime
+from collections import Counter
+
+from src import config
+from src import constants
+from src.logging_config import QUERY_LOG_FILE
+from src.answer_index import AnswerIndex, QUERY_EMBEDDING_TASK_TYPE, normalize_query
+from src.embeddings import CompactEmbedding, dot_product
+from src.rag_handler import (
+    handle_retrieval, get_stream, _fetch_records_from_db, _get_text_embedding,
+    _generate_hypothetical_document, _split_last_brackets
+)
+
+# HyDE の応答末尾の [Language] から言語を決める。_extract_language は不明な言語を英語とみなすので使わない。
+LANGUAGES = {
+    language.lower(): language
+    for language in (constants.ENGLISH, constants.JAPANESE, constants.SPANISH, constants.INDONESIAN,
+                     constants.KOREAN, constants.VIETNAMESE, constants.THAI)
+}
+
+
+def _read_query_log(pattern: str) -> tuple[Counter, dict[str, str]]:
+    counts = Counter()
+    originals = {}
+    for path in glob.glob(pattern) + glob.glob(pattern + '.*'):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    query = json.loads(line)["query"]
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if not query or not query.strip():
+                    continue
+                normalized = normalize_query(query[:config.MAX_INPUT])
+                counts[normalized] += 1
+                originals.setdefault(normalized, query.strip())
+    return counts, originals
+
+
+def _embed(text: str) -> list[float]:
+    return _get_text_embedding(
+        text,
+        output_dimensionality=config.EMBEDDING_DIMENSIONS,
+        task_type=QUERY_EMBEDDING_TASK_TYPE
+    )
+
+
+def _detect_language(query: str) -> str | None:
+    """Returns the language the HyDE call reports for a question, or None if it is not one we answer in."""
+    _, bracket_part = _split_last_brackets(_generate_hypothetical_document(query))
+    return LANGUAGES.get(bracket_part.strip('[] ').lower())
+
+
+def _detect_languages(counts: Counter, originals: dict, cache_path: str, delay: float) -> dict[str, str | None]:
+    """Detects the language of every question, reusing the results of previous runs."""
+    languages = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, encoding='utf-8') as f:
+            languages = json.load(f)
+
+    missing = [normalized for normalized in counts if normalized not in languages]
+    print(f"Detecting the language of {len(missing)} questions ({len(counts) - len(missing)} cached)...")
+    for normalized in missing:
+        try:
+            languages[normalized] = _detect_language(originals[normalized])
+        except Exception as e:
+            # キャッシュしないので、次回の実行でもう一度判定する
+            print(f"Could not detect the language of '{originals[normalized]}': {e}")
+            continue
+        time.sleep(delay)
+
+    directory = os.path.dirname(cache_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(cache_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(languages, f, ensure_ascii=False)
+    os.replace(cache_path + '.tmp', cache_path)
+    return languages
+
+
+def _cluster(counts: Counter, originals: dict, embeddings: dict, languages: dict, similarity: float) -> list[dict]:
+    """
+    Greedy leader clustering: each question joins the first (more frequent) leader it is similar enough to.
+
+    Embeddings match across languages, so a question only joins a leader of the same language.
+    """
+    clusters = []
+    for normalized, count in counts.most_common():
+        language = languages[normalized]
+        vector = embeddings[normalized]
+        for cluster in clusters:
+            if cluster["language"] == language and dot_product(vector, cluster["vector"]) >= similarity:
+                cluster["aliases"].append(normalized)
+                cluster["count"] += count
+                break
+        else:
+            clusters.append({
+                "query": originals[normalized],
+                "aliases": [normalized],
+                "count": count,
+                "vector": vector,
+                "language": language,
+            })
+    return sorted(clusters, key=lambda cluster: cluster["count"], reverse=True)
+
+
+def _current_chunk_versions(chunk_ids: list[str]) -> dict[str, str]:
+    rows = _fetch_records_from_db([{"id": chunk_id} for chunk_id in chunk_ids])
+    return {row.id: row.scraped_at.isoformat() for row in rows}
+
+
+def _is_fresh(entry: dict, current_versions: dict[str, str]) -> bool:
+    return all(current_versions.get(chunk_id) == version for chunk_id, version in entry["chunk_versions"].items())
+
+
+def _answer(query: str) -> dict:
+    final_context, language, sources = handle_retrieval(query)
+    answer = ''.join(chunk.text or '' for chunk in get_stream(inputText=query, docs=final_context, language=language))
+    return {
+        "answer": answer,
+        "language": language,
+        "sources": sources,
+        "chunk_versions": _current_chunk_versions([source["id"] for source in sources]),
+        "answered_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--query-log', default=QUERY_LOG_FILE)
+    parser.add_argument('--top', type=int, default=300, help='Number of question clusters to keep.')
+    parser.add_argument('--min-count', type=int, default=3, help='Ignore clusters asked fewer times than this.')
+    parser.add_argument('--max-questions', type=int, default=5000, help='Most frequent distinct questions to cluster.')
+    parser.add_argument('--similarity', type=float, default=config.ANSWER_INDEX_SIMILARITY)
+    parser.add_argument('--delay', type=float, default=0.5, help='Seconds to wait between Gemini calls.')
+    parser.add_argument('--output', default=config.ANSWER_INDEX_PATH)
+    parser.add_argument('--refresh-only', action='store_true')
+    args = parser.parse_args()
+
+    existing = None
+    if os.path.exists(args.output + '.json'):
+        try:
+            existing = AnswerIndex.load(args.output)
+            print(f"Loaded existing index with {len(existing)} entries.")
+        except ValueError as e:
+            # 古い形式のインデックスは再利用せず、すべて作り直す
+            print(f"Ignoring existing index: {e}")
+
+    if args.refresh_only:
+        if existing is None:
+            parser.error('--refresh-only needs an existing index.')
+        clusters = [
+            {"query": entry["query"], "aliases": entry.get("aliases", []), "count": entry.get("count", 0),
+             "vector": embedding.to_values(), "language": entry["language"]}
+            for entry, embedding in zip(existing.entries, existing.embeddings)
+        ]
+    else:
+        counts, originals = _read_query_log(args.query_log)
+        counts = Counter(dict(counts.most_common(args.max_questions)))
+        languages = _detect_languages(counts, originals, args.output + '.languages.json', args.delay)
+        # 言語を判定できなかった質問は、どの言語の質問にも返せないので除く
+        counts = Counter({normalized: count for normalized, count in counts.items() if languages.get(normalized)})
+        print(f"Embedding {len(counts)} distinct questions...")
+        embeddings = {normalized: _embed(originals[normalized]) for normalized in counts}
+        clusters = [
+            cluster for cluster in _cluster(counts, originals, embeddings, languages, args.similarity)
+            if cluster["count"] >= args.min_count
+        ][:args.top]
+    print(f"Building answers for {len(clusters)} question clusters.")
+
+    previous_entries = {}
+    current_versions = {}
+    if existing is not None:
+        previous_entries = {normalize_query(entry["query"]): entry for entry in existing.entries}
+        chunk_ids = sorted({chunk_id for entry in existing.entries for chunk_id in entry["chunk_versions"]})
+        current_versions = _current_chunk_versions(chunk_ids) if chunk_ids else {}
+
+    entries = []
+    compact_embeddings = []
+    reused = generated = failed = 0
+    for cluster in clusters:
+        previous = previous_entries.get(normalize_query(cluster["query"]))
+        if previous is not None and _is_fresh(previous, current_versions):
+            answer = {key: previous[key] for key in ("answer", "language", "sources", "chunk_versions", "answered_at")}
+            reused += 1
+        else:
+            try:
+                answer = _answer(cluster["query"])
+            except Exception as e:
+                print(f"Skipping '{cluster['query']}': {e}")
+                failed += 1
+                continue
+            generated += 1
+            time.sleep(args.delay)
+
+        if answer["language"] != cluster["language"]:
+            # 検索時の判定が質問の言語と食い違う回答は、別の言語の質問に返してしまう恐れがあるので保存しない
+            print(f"Skipping '{cluster['query']}': answered in {answer['language']}, asked in {cluster['language']}.")
+            failed += 1
+            continue
+
+        entries.append({"query": cluster["query"], "aliases": cluster["aliases"], "count": cluster["count"],
+                        **answer})
+        compact_embeddings.append(CompactEmbedding.from_values(cluster["vector"]))
+
+    AnswerIndex(entries, compact_embeddings).save(args.output)
+    print(f"Saved {len(entries)} entries to {args.output} (reused: {reused}, generated: {generated}, failed: {failed}).")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Compares latency and token usage of every generation profile on a fixed question set.
+
+HyDE profiles get the HyDE prompt. QA profiles get the QA prompt with the context that
+handle_retrieval returns for each question. Retrieval runs once per question and is shared
+by all QA profiles. Profiles are called directly, with no routing or fallback, so each row
+measures only that profile.
+
+Usage (from the backend directory):
+    python -m scripts.compare_generation_profiles [--questions questions.txt] [--repeat 3]
+"""
+import argparse
+import statistics
+import time
+
+from src import config
+from src import prompts
+from src.rag_handler import client, handle_retrieval, _build_generation_config
+
+# 言語・長さの異なる代表的な質問
+DEFAULT_QUESTIONS = [
+    "How do I turn on channel memberships?",
+    "What is the revenue share for Shorts?",
+    "Can I schedule a premiere for a live stream?",
+    "Why was my video demonetized?",
+    "How long can a YouTube Short be?",
+    "チャンネルメンバーシップの条件は何ですか？",
+    "ショート動画のサムネイルを変更する方法を教えてください。",
+    "¿Cómo puedo verificar mi canal de YouTube?",
+    "Bagaimana cara mengaktifkan monetisasi?",
+    "유튜브 프리미어 기능은 어떻게 사용하나요?",
+]
+
+
+def _profile_stage(profile_name: str) -> str:
+    return 'hyde' if profile_name.startswith('hyde') else 'qa'
+
+
+def _usage(response) -> tuple[int, int, int]:
+    usage = response.usage_metadata if response is not None else None
+    if usage is None:
+        return 0, 0, 0
+    return (
+        usage.prompt_token_count or 0,
+        usage.candidates_token_count or 0,
+        usage.thoughts_token_count or 0,
+    )
+
+
+def _run_hyde(profile: dict, question: str) -> dict:
+    start_time = time.time()
+    response = client.models.generate_content(
+        model=profile['model'],
+        contents=prompts.HYDE_PROMPT + question,
+        config=_build_generation_config(profile),
+    )
+    elapsed_time = time.time() - start_time
+    prompt_tokens, output_tokens, thought_tokens = _usage(response)
+    return {"latency": elapsed_time, "first_chunk": elapsed_time, "prompt_tokens": prompt_tokens,
+            "output_tokens": output_tokens, "thought_tokens": thought_tokens}
+
+
+def _run_qa(profile: dict, question: str, context: str, language: str) -> dict:
+    qa_prompt = prompts.QA_PROMPT.format(language=language, context=context) + " Here's the question: " + question
+    start_time = time.time()
+    first_chunk_time = None
+    last_chunk = None
+    for chunk in client.models.generate_content_stream(
+        model=profile['model'],
+        contents=qa_prompt,
+        config=_build_generation_config(profile),
+    ):
+        if first_chunk_time is None:
+            first_chunk_time = time.time() - start_time
+        last_chunk = chunk
+    elapsed_time = time.time() - start_time
+    # ストリームでは、使用トークン数は最後のチャンクに集計される
+    prompt_tokens, output_tokens, thought_tokens = _usage(last_chunk)
+    return {"latency": elapsed_time, "first_chunk": first_chunk_time or elapsed_time, "prompt_tokens": prompt_tokens,
+            "output_tokens": output_tokens, "thought_tokens": thought_tokens}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--questions', help='Text file with one question per line.')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per question and profile.')
+    args = parser.parse_args()
+
+    if args.questions:
+        with open(args.questions, encoding='utf-8') as f:
+            questions = [line.strip() for line in f if line.strip()]
+    else:
+        questions = DEFAULT_QUESTIONS
+
+    contexts = {}
+    for question in questions:
+        final_context, language, _ = handle_retrieval(question)
+        contexts[question] = (final_context, language)
+
+    print(f"| profile | model | runs | avg latency (s) | p95 latency (s) | avg first chunk (s) "
+          f"| avg prompt tok | avg output tok | avg thought tok |")
+    print("|---|---|---|---|---|---|---|---|---|")
+    for profile_name, profile in config.GENERATION_PROFILES.items():
+        stage = _profile_stage(profile_name)
+        results = []
+        for question in questions:
+            for _ in range(args.repeat):
+                if stage == 'hyde':
+                    results.append(_run_hyde(profile, question))
+                else:
+                    results.append(_run_qa(profile, question, *contexts[question]))
+
+        latencies = sorted(result["latency"] for result in results)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+        def avg(key):
+            return statistics.mean(result[key] for result in results)
+
+        print(f"| {profile_name} | {profile['model']} | {len(results)} | {avg('latency'):.2f} | {p95:.2f} "
+              f"| {avg('first_chunk'):.2f} | {avg('prompt_tokens'):.0f} | {avg('output_tokens'):.0f} "
+              f"| {avg('thought_tokens'):.0f} |")
+
+
+if __name__ == '__main__':
+    main()
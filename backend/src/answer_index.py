@@ -0,0 +1,197 @@
+import os
+import re
+import json
+import datetime
+import threading
+import unicodedata
+from collections import Counter
+
+from src import config
+from src import constants
+from src.embeddings import CompactEmbedding, BYTES_PER_DIMENSION, dot_product, truncate_embedding
+
+import logging
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 2
+# 質問の照合には、検索用ではなく質問同士の類似度に向いたタスクタイプで埋め込みを作る
+QUERY_EMBEDDING_TASK_TYPE = "SEMANTIC_SIMILARITY"
+
+_TRAILING_PUNCTUATION = re.compile(r"[\s\?\!\.。？！、,]+$")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    """Normalizes a question for exact matching (width, case, whitespace and trailing punctuation)."""
+    text = unicodedata.normalize('NFKC', text).lower().strip()
+    text = _WHITESPACE.sub(' ', text)
+    return _TRAILING_PUNCTUATION.sub('', text)
+
+
+# ベトナム語に特有の文字 (ラテン文字拡張追加の範囲と đ, ơ, ư)
+_VIETNAMESE_LETTERS = set('đĐơƠưƯ')
+
+
+def detect_language(text: str) -> str | None:
+    """
+    Returns the language of a question when its script alone identifies it: Japanese, Korean, Thai or Vietnamese.
+
+    Returns None otherwise. English, Spanish and Indonesian share the Latin script, and a question
+    written only in kanji may be Chinese, so their language can only be told by the model (the batch
+    job records it per question). Other scripts such as Cyrillic or Arabic also return None.
+    """
+    counts = Counter()
+    for char in text:
+        if not char.isalpha():
+            continue
+        if char in _VIETNAMESE_LETTERS or 0x1EA0 <= ord(char) <= 0x1EFF:
+            counts[constants.VIETNAMESE] += 1
+            continue
+        name = unicodedata.name(char, '')
+        if name.startswith(('HIRAGANA', 'KATAKANA')):
+            counts[constants.JAPANESE] += 1
+        elif name.startswith('HANGUL'):
+            counts[constants.KOREAN] += 1
+        elif name.startswith('THAI'):
+            counts[constants.THAI] += 1
+
+    # ラテン文字は数えないので、"YouTube" などの英字が混ざっていても質問本体の言語が選ばれる
+    if not counts:
+        return None
+    return counts.most_common(1)[0][0]
+
+
+class AnswerIndex:
+    """
+    Precomputed answers for recurring questions, keyed by normalized text and by query embedding.
+
+    On disk the index is two files: `<path>.json` holds the entries, and `<path>.bin` holds
+    their compact embeddings, back to back in entry order.
+    """
+
+    def __init__(self, entries: list[dict], embeddings: list[CompactEmbedding],
+                 dimensions: int = config.EMBEDDING_STORAGE_DIMENSIONS,
+                 dtype: str = config.EMBEDDING_STORAGE_DTYPE,
+                 built_at: str | None = None):
+        if len(entries) != len(embeddings):
+            raise ValueError("Each answer index entry needs exactly one embedding.")
+        self.entries = entries
+        self.embeddings = embeddings
+        self.dimensions = dimensions
+        self.dtype = dtype
+        self.built_at = built_at
+
+        # 別名は、バッチが代表の質問と同じ言語だと確認したものだけが入っている
+        self._by_text: dict[str, int] = {}
+        for i, entry in enumerate(entries):
+            for text in [entry["query"], *entry.get("aliases", [])]:
+                self._by_text.setdefault(normalize_query(text), i)
+        # 照合のたびに復元しないよう、読み込み時に一度だけ float に戻しておく
+        self._vectors = [embedding.to_values() for embedding in embeddings]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return f"<AnswerIndex entries:{len(self.entries)} dimensions:{self.dimensions} dtype:'{self.dtype}'>"
+
+    def lookup_text(self, user_query: str) -> dict | None:
+        """Returns the entry whose question (or alias) matches the query after normalization."""
+        i = self._by_text.get(normalize_query(user_query))
+        return self.entries[i] if i is not None else None
+
+    def lookup_embedding(self, query_embedding: list[float], user_query: str,
+                         threshold: float = config.ANSWER_INDEX_SIMILARITY) -> dict | None:
+        """
+        Returns the most similar entry in the query's language, if its cosine similarity reaches the threshold.
+
+        Embeddings of the same question match across languages, so nothing is returned unless
+        detect_language can confirm the query's language and compare it with the entry's.
+        """
+        language = detect_language(user_query)
+        if language is None:
+            return None
+        candidates = [i for i, entry in enumerate(self.entries) if entry["language"] == language]
+        if not candidates:
+            return None
+        query_vector = truncate_embedding(query_embedding, self.dimensions)
+        scores = {i: dot_product(query_vector, self._vectors[i]) for i in candidates}
+        best = max(scores, key=scores.get)
+        logger.debug(f"Best answer index similarity: {scores[best]:.4f} ({self.entries[best]['query']})")
+        return self.entries[best] if scores[best] >= threshold else None
+
+    def save(self, path: str = config.ANSWER_INDEX_PATH) -> None:
+        """Writes the index atomically, so a running server never reads a half-written file."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        header = {
+            "version": INDEX_VERSION,
+            "built_at": self.built_at or datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "dimensions": self.dimensions,
+            "dtype": self.dtype,
+            "entries": [
+                {**entry, "scale": embedding.scale}
+                for entry, embedding in zip(self.entries, self.embeddings)
+            ],
+        }
+        # .bin を先に置き換え、最後に .json を置き換える (サーバーは .json の更新を検知して読み直す)
+        with open(path + '.bin.tmp', 'wb') as f:
+            for embedding in self.embeddings:
+                f.write(embedding.data)
+        with open(path + '.json.tmp', 'w', encoding='utf-8') as f:
+            json.dump(header, f, ensure_ascii=False)
+        os.replace(path + '.bin.tmp', path + '.bin')
+        os.replace(path + '.json.tmp', path + '.json')
+
+    @classmethod
+    def load(cls, path: str = config.ANSWER_INDEX_PATH) -> 'AnswerIndex':
+        with open(path + '.json', encoding='utf-8') as f:
+            header = json.load(f)
+        if header.get("version") != INDEX_VERSION:
+            raise ValueError(f"Unsupported answer index version: {header.get('version')}")
+        with open(path + '.bin', 'rb') as f:
+            data = f.read()
+
+        dimensions = header["dimensions"]
+        dtype = header["dtype"]
+        vector_size = dimensions * BYTES_PER_DIMENSION[dtype]
+        if len(data) != vector_size * len(header["entries"]):
+            raise ValueError("Answer index embeddings do not match its entries.")
+
+        entries = []
+        embeddings = []
+        for i, entry in enumerate(header["entries"]):
+            scale = entry.pop("scale", 1.0)
+            entries.append(entry)
+            embeddings.append(CompactEmbedding(dtype, dimensions, scale, data[i * vector_size:(i + 1) * vector_size]))
+        return cls(entries, embeddings, dimensions, dtype, header.get("built_at"))
+
+
+_index: AnswerIndex | None = None
+_index_mtime: float | None = None
+_index_lock = threading.Lock()
+
+
+def get_index(path: str = config.ANSWER_INDEX_PATH) -> AnswerIndex | None:
+    """Returns the answer index, reloading it when the batch job has rebuilt it. Returns None if there is none."""
+    global _index, _index_mtime
+    try:
+        mtime = os.path.getmtime(path + '.json')
+    except OSError:
+        return None
+    if mtime == _index_mtime:
+        return _index
+
+    with _index_lock:
+        if mtime != _index_mtime:
+            try:
+                _index = AnswerIndex.load(path)
+                logger.info(f"Loaded answer index with {len(_index)} entries (built at {_index.built_at}).")
+            except (OSError, ValueError, KeyError) as e:
+                # 壊れたインデックスでは回答しない。通常の RAG パイプラインにフォールバックさせる。
+                logger.error(f"Failed to load answer index from {path}: {e}")
+                _index = None
+            _index_mtime = mtime
+    return _index
@@ -1,4 +1,5 @@
 import os
+import json
 from google.cloud import secretmanager
 from dotenv import load_dotenv
 
@@ -10,9 +11,70 @@ LOCATION = os.getenv('LOCATION')
 GEMINI_HYDE_MODEL = 'gemini-2.5-flash'
 GEMINI_EMBEDDING_MODEL = 'gemini-embedding-001'
 GEMINI_QA_MODEL = 'gemini-2.5-flash'
+GEMINI_LITE_MODEL = 'gemini-2.5-flash-lite'
 # GEMINI_RERANK_MODEL = 'gemini-2.5-flash'
 
+# 生成ステージごとのプロファイル。
+#   thinking_budget: 思考トークンの上限 (0 で思考なし、None でモデルのデフォルト)
+#   max_output_tokens: 出力トークンの上限 (Gemini 2.5 では思考トークンも含まれる)
+GENERATION_PROFILES = {
+    # HyDE は2文 + [言語] を返すだけなので、思考なしの軽量モデルで十分
+    'hyde_lite': {
+        'model': GEMINI_LITE_MODEL,
+        'thinking_budget': 0,
+        'max_output_tokens': 256,
+        'temperature': 0.2,
+        'stop_sequences': [],
+    },
+    'hyde': {
+        'model': GEMINI_HYDE_MODEL,
+        'thinking_budget': 0,
+        'max_output_tokens': 256,
+        'temperature': 0.2,
+        'stop_sequences': [],
+    },
+    'qa_short': {
+        'model': GEMINI_QA_MODEL,
+        'thinking_budget': 0,
+        'max_output_tokens': 512,
+        'temperature': 0.2,
+        'stop_sequences': [],
+    },
+    'qa': {
+        'model': GEMINI_QA_MODEL,
+        'thinking_budget': 1024,
+        'max_output_tokens': 2048,
+        'temperature': 0.2,
+        'stop_sequences': [],
+    },
+}
+
+# ステージごとに試すプロファイルの順番。先頭が失敗した場合 (過負荷・モデル未提供など) は次へフォールバックする。
+# また、直近のレイテンシが STAGE_LATENCY_BUDGETS を超えているプロファイルは後回しにする。
+STAGE_ROUTES = {
+    'hyde': ['hyde_lite', 'hyde'],
+    'qa_short': ['qa_short', 'qa'],
+    'qa': ['qa', 'qa_short'],
+}
+# 秒。HyDE は応答完了まで、QA は最初のトークンが届くまでの時間
+STAGE_LATENCY_BUDGETS = {
+    'hyde': 2.0,
+    'qa_short': 2.0,
+    'qa': 4.0,
+}
+# 予算超過やエラーで後回しにしたプロファイルを、この秒数が経ったら先頭に戻して再び試す。
+# (一度の遅い呼び出しで、そのプロファイルが永久に使われなくなるのを防ぐ)
+PROFILE_PENALTY_SECONDS = 60
+# この文字数以下の質問は 'qa_short' ルートで回答する
+SHORT_QUESTION_MAX_CHARS = 40
+
 EMBEDDING_DIMENSIONS = 3072
+# gemini-embedding-001 は Matryoshka 表現学習で訓練されているため、先頭の次元だけを切り出しても
+# 意味を保ったベクトルになる。ローカルにキャッシュ・保存するベクトルはこの次元数と型で圧縮する。
+# (Vector Search のインデックスは 3072 次元なので、検索クエリ自体は EMBEDDING_DIMENSIONS のまま)
+MATRYOSHKA_DIMENSIONS = (768, 1536, 3072)
+EMBEDDING_STORAGE_DIMENSIONS = 768
+EMBEDDING_STORAGE_DTYPE = 'float16'  # 'float32' | 'float16' | 'int8'
 VECTOR_INDEX_REGION = 'us-central1'
 INDEX_ENDPOINT_NAME = "projects/59085630263/locations/us-central1/indexEndpoints/7609185613186596864"
 DEPLOYED_INDEX_ID = 'youtube_help'
@@ -20,6 +82,25 @@ DEPLOYED_INDEX_ID = 'youtube_help'
 MAX_INPUT = 200
 K = 4
 
+# 検索先のルーティングテーブル。検出した言語に一致するシャードすべてに並列で検索をかけ、
+# 距離順にマージして上位 K 件を使う。
+#   deployed_index_id: 検索するデプロイ済みインデックス
+#   languages: 対象とする言語 (None なら全言語)
+#   num_neighbors: このシャードから取得する件数
+#   restricts: restricts の namespace -> allow_tokens。'{language}' は検出した言語に置き換えられる。
+# 例: 日本語専用インデックスを追加し、カテゴリで絞り込む場合
+#   {'deployed_index_id': 'youtube_help_ja', 'languages': ['Japanese'], 'num_neighbors': K,
+#    'restricts': {'category': ['Create Shorts', 'Manage your channel']}},
+VECTOR_SEARCH_SHARDS = [
+    {
+        'deployed_index_id': DEPLOYED_INDEX_ID,
+        'languages': None,
+        'num_neighbors': K,
+        'restricts': {},
+    },
+]
+MAX_SHARD_WORKERS = 8
+
 def access_secret_version(project_id, secret_id, version_id="latest"):
     client = secretmanager.SecretManagerServiceClient()
     name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
@@ -32,6 +113,60 @@ CLOUDSQL_PASSWORD = access_secret_version(PROJECT_ID, 'TrueNorthDataBasePassword
 DB_HOST = os.getenv('DB_HOST', '127.0.0.1')
 CLOUDSQL_DATABASE = 'true-north-db'
 INSTANCE_CONNECTION_NAME = 'arvato-developments:europe-west1:true-north'
+
+# チャンク読み出し専用の Cloud SQL リードレプリカ。環境変数 CLOUDSQL_READ_REPLICAS で指定する。
+#   カンマ区切りの接続名: 全てのレプリカが READ_REPLICA_POOL_DEFAULTS を使う
+#     "proj:region:replica-1,proj:region:replica-2"
+#   JSON の配列: レプリカごとにプールサイズを調整できる (省略した項目はデフォルト値)
+#     '[{"instance_connection_name": "proj:region:replica-1", "pool_size": 10, "max_overflow": 10},
+#       {"instance_connection_name": "proj:region:replica-2", "pool_size": 3, "pool_timeout": 1}]'
+# (接続名自体に ':' が含まれるため、区切り文字で値を並べる形式にはしていない)
+# pool_timeout を短くしておくことで、詰まったレプリカを早めに諦めて次のレプリカ/プライマリへ回す。
+READ_REPLICA_POOL_DEFAULTS = {
+    'pool_size': 5,
+    'max_overflow': 5,
+    'pool_timeout': 3,
+}
+
+
+def _parse_read_replicas(value: str) -> list[dict]:
+    value = value.strip()
+    if not value:
+        return []
+    if value.startswith('['):
+        return [{**READ_REPLICA_POOL_DEFAULTS, **replica} for replica in json.loads(value)]
+    return [
+        {'instance_connection_name': name.strip(), **READ_REPLICA_POOL_DEFAULTS}
+        for name in value.split(',') if name.strip()
+    ]
+
+
+CLOUDSQL_READ_REPLICAS = _parse_read_replicas(os.getenv('CLOUDSQL_READ_REPLICAS', ''))
+
+# 管理用エンドポイントの認証トークン。未設定の場合、管理用エンドポイントは無効になる。
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+# --- プロファイリング ---
+# 処理時間がこの秒数を超えたリクエストは、ステージごとの所要時間とスタックサンプルを自動で保存する
+SLOW_REQUEST_THRESHOLD = 5.0
+# 常時動かす低頻度サンプリングの間隔(秒)。None にすると、管理用エンドポイントで有効化した間だけサンプリングする
+PROFILE_BACKGROUND_SAMPLE_INTERVAL = 0.1
+# 管理用エンドポイントでサンプリングを有効化している間の間隔(秒)
+PROFILE_SAMPLE_INTERVAL = 0.01
+MAX_PROFILING_SECONDS = 300
+# 保存先ディレクトリと、保持するキャプチャの最大数 (古いものから削除されるリングバッファ)
+PROFILE_DIR = os.path.join('logs', 'profiles')
+PROFILE_RING_SIZE = 200
+
+# --- 回答インデックス (よくある質問の事前計算済み回答) ---
+# scripts/build_answer_index.py がオフピーク時に生成する。ファイルが無ければこの機能は使われない。
+ANSWER_INDEX_PATH = os.path.join('data', 'answer_index')
+# 完全一致しなかった質問を、埋め込みの類似度で照合するかどうか (埋め込み API を1回呼ぶが、生成は行わない)
+# 照合は検索と並行して行うので、ヒットしなかったリクエストの待ち時間は増えない (ヒットした場合は検索を打ち切る)
+# 英語・スペイン語・インドネシア語など、文字から言語を確定できない質問は照合しない (完全一致のみ)
+ANSWER_INDEX_EMBEDDING_LOOKUP = True
+# 類似度 (コサイン) がこの値以上なら、同じ質問とみなして事前計算済みの回答を返す
+ANSWER_INDEX_SIMILARITY = 0.95
 # DATABASE_URL = ('mysql+pymysql://{user}:{password}@{host}:3306/{database}?charset=utf8mb4').format(
 #     user=CLOUDSQL_USER,
 #     password=CLOUDSQL_PASSWORD,
@@ -0,0 +1,93 @@
+import math
+import operator
+import struct
+from array import array
+
+from src import config
+
+import logging
+logger = logging.getLogger(__name__)
+
+FLOAT32 = 'float32'
+FLOAT16 = 'float16'
+INT8 = 'int8'
+SUPPORTED_DTYPES = (FLOAT32, FLOAT16, INT8)
+
+# 1次元あたりのバイト数。キャッシュやインデックスのサイズ見積もりに使う。
+BYTES_PER_DIMENSION = {FLOAT32: 4, FLOAT16: 2, INT8: 1}
+
+
+def truncate_embedding(values: list[float], dimensions: int) -> list[float]:
+    """
+    Truncates a Matryoshka embedding to its first `dimensions` values and re-normalizes it.
+
+    Only the full 3072-d output of gemini-embedding-001 is unit-normalized, so a truncated
+    vector must be normalized again before it can be compared with a dot product.
+    """
+    if dimensions > len(values):
+        raise ValueError(f"Cannot truncate a {len(values)}-d embedding to {dimensions} dimensions.")
+
+    truncated = values[:dimensions]
+    norm = math.sqrt(sum(v * v for v in truncated))
+    if norm == 0:
+        return list(truncated)
+    return [v / norm for v in truncated]
+
+
+class CompactEmbedding:
+    """An array-backed, optionally quantized embedding for local caches and indexes."""
+
+    __slots__ = ('dtype', 'dimensions', 'scale', 'data')
+
+    def __init__(self, dtype: str, dimensions: int, scale: float, data: bytes):
+        self.dtype = dtype
+        self.dimensions = dimensions
+        # int8 の場合のみ使用する、量子化前の値に戻すための係数
+        self.scale = scale
+        self.data = data
+
+    @classmethod
+    def from_values(
+        cls,
+        values: list[float],
+        dimensions: int = config.EMBEDDING_STORAGE_DIMENSIONS,
+        dtype: str = config.EMBEDDING_STORAGE_DTYPE
+    ) -> 'CompactEmbedding':
+        """Truncates and quantizes a full-precision embedding."""
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"Unsupported embedding dtype: {dtype}")
+
+        truncated = truncate_embedding(values, dimensions)
+
+        if dtype == FLOAT32:
+            return cls(dtype, dimensions, 1.0, array('f', truncated).tobytes())
+
+        if dtype == FLOAT16:
+            # array モジュールは半精度を扱えないため、struct の 'e' フォーマットでパックする
+            return cls(dtype, dimensions, 1.0, struct.pack(f'<{dimensions}e', *truncated))
+
+        # int8: ベクトルごとの対称量子化 (最大絶対値を 127 に対応させる)
+        max_abs = max((abs(v) for v in truncated), default=0.0)
+        scale = max_abs / 127 if max_abs else 1.0
+        quantized = array('b', (round(v / scale) for v in truncated))
+        return cls(dtype, dimensions, scale, quantized.tobytes())
+
+    def to_values(self) -> list[float]:
+        """Restores the (approximate) float values of the embedding."""
+        if self.dtype == FLOAT32:
+            return array('f', self.data).tolist()
+        if self.dtype == FLOAT16:
+            return list(struct.unpack(f'<{self.dimensions}e', self.data))
+        return [v * self.scale for v in array('b', self.data)]
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.data)
+
+    def __repr__(self):
+        return f"<CompactEmbedding dtype:'{self.dtype}' dimensions:{self.dimensions} nbytes:{self.nbytes}>"
+
+
+def dot_product(a: list[float], b: list[float]) -> float:
+    """Returns the dot product of two vectors (cosine similarity for normalized vectors)."""
+    return sum(map(operator.mul, a, b))
@@ -21,6 +21,10 @@ class NonRetryableRetrievalError(RetrievalError):
     """Retrieval error that will not succeed on retry (e.g., invalid API key, non-existent index)."""
     pass
 
+class RetrievalCancelledError(RetrievalError):
+    """Retrieval was stopped because its result is no longer needed (e.g., the question was answered from the answer index)."""
+    pass
+
 # GenerationError can be extended in the same way
 class RetryableGenerationError(GenerationError):
     """Retryable generation error (e.g., LLM is temporarily overloaded)."""
@@ -6,6 +6,8 @@ LOG_DIR = "logs"
 # ユーザーがプロジェクトのトップ階層で streamlit run app.py というコマンドを実行した場合、そのコマンドを実行した場所、
 # つまりプロジェクトのトップ階層がカレントワーキングディレクトリになり、そこに logs というフォルダが生成されます。
 os.makedirs(LOG_DIR, exist_ok=True)
+# ユーザーの質問を1行1件の JSON で記録するファイル。回答インデックスのバッチ (scripts/build_answer_index.py) が読む。
+QUERY_LOG_FILE = os.path.join(LOG_DIR, 'queries.log')
 
 LOGGING_CONFIG = {
     'version': 1,
@@ -25,6 +27,9 @@ LOGGING_CONFIG = {
         'detailed': {
             'format': '%(asctime)s - %(name)s:%(funcName)s:%(lineno)d - %(levelname)s - %(message)s',
         },
+        'message_only': {
+            'format': '%(message)s',
+        },
     },
 
     'handlers': {
@@ -44,6 +49,15 @@ LOGGING_CONFIG = {
             'backupCount': 3,
             'encoding': 'utf-8',
         },
+        'query_log': {
+            'class': 'logging.handlers.RotatingFileHandler',
+            'level': 'INFO',
+            'formatter': 'message_only',
+            'filename': QUERY_LOG_FILE,
+            'maxBytes': 1024 * 1024 * 20,  # 20 MB
+            'backupCount': 5,
+            'encoding': 'utf-8',
+        },
     },
 
     'loggers': {
@@ -60,6 +74,13 @@ LOGGING_CONFIG = {
         # ハンドラは設定せず、ログをルートに伝播させて処理を任せます。
         'src': {
             'level': 'DEBUG',
+        },
+
+        # 3. 質問ログ専用のロガー。アプリのログに混ざらないよう、ルートには伝播させない。
+        'src.query_log': {
+            'handlers': ['query_log'],
+            'level': 'INFO',
+            'propagate': False,
         }
     }
 }
@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import time
+import datetime
+import threading
+from collections import Counter, deque
+from contextlib import contextmanager
+
+from src import config
+
+import logging
+logger = logging.getLogger(__name__)
+
+# 1サンプルあたりに記録するスタックの最大深さ
+MAX_STACK_DEPTH = 64
+
+
+class RequestProfile:
+    """Per-stage timings and stack samples of a single request."""
+
+    def __init__(self, response_id: str):
+        self.response_id = response_id
+        self.thread_id = threading.get_ident()
+        self.started_at = datetime.datetime.now(datetime.timezone.utc)
+        self.start_time = time.perf_counter()
+        self.stages: list[tuple[str, float]] = []
+        # "file:function:line;..." の形式 (flamegraph の collapsed 形式) で畳み込んだスタック -> 出現回数
+        self.samples: Counter = Counter()
+
+    def __repr__(self):
+        return f"<RequestProfile response_id:'{self.response_id}' stages:{len(self.stages)}>"
+
+
+_local = threading.local()
+# サンプラーが参照する、実行中のリクエスト (スレッドID -> プロファイル)
+_active_profiles: dict[int, RequestProfile] = {}
+_active_profiles_lock = threading.Lock()
+
+# 管理用エンドポイントで有効化された高頻度サンプリングの終了時刻 (time.monotonic 基準)
+_sampling_until = 0.0
+_sampler_thread: threading.Thread | None = None
+_sampler_lock = threading.Lock()
+
+_ring: deque[str] | None = None
+_ring_lock = threading.Lock()
+
+
+def is_sampling_enabled() -> bool:
+    return time.monotonic() < _sampling_until
+
+
+def enable_sampling(seconds: float) -> float:
+    """Turns on high-frequency stack sampling for the given number of seconds (capped). Returns the actual duration."""
+    global _sampling_until
+    seconds = max(0.0, min(float(seconds), config.MAX_PROFILING_SECONDS))
+    _sampling_until = time.monotonic() + seconds
+    _ensure_sampler()
+    logger.info(f"Sampling profiler enabled for {seconds:.0f} seconds.")
+    return seconds
+
+
+def get_status() -> dict:
+    remaining = max(0.0, _sampling_until - time.monotonic())
+    with _active_profiles_lock:
+        active_requests = len(_active_profiles)
+    return {
+        "sampling": remaining > 0,
+        "remaining_seconds": round(remaining, 1),
+        "active_requests": active_requests,
+        "slow_request_threshold": config.SLOW_REQUEST_THRESHOLD,
+        "profile_dir": config.PROFILE_DIR,
+    }
+
+
+def start_request(response_id: str) -> RequestProfile:
+    """Starts profiling the request handled by the current thread."""
+    profile = RequestProfile(response_id)
+    _local.profile = profile
+    with _active_profiles_lock:
+        _active_profiles[profile.thread_id] = profile
+    _ensure_sampler()
+    return profile
+
+
+def finish_request(profile: RequestProfile) -> None:
+    """Stops profiling and writes a capture if the request was slow or sampling is enabled."""
+    _local.profile = None
+    with _active_profiles_lock:
+        _active_profiles.pop(profile.thread_id, None)
+
+    total_seconds = time.perf_counter() - profile.start_time
+    if total_seconds < config.SLOW_REQUEST_THRESHOLD and not is_sampling_enabled():
+        return
+
+    try:
+        _write_capture(profile, total_seconds)
+    except OSError as e:
+        # プロファイルの保存失敗でリクエスト処理自体を失敗させない
+        logger.warning(f"Failed to write profile capture for {profile.response_id}: {e}")
+
+
+@contextmanager
+def bind(profile: RequestProfile):
+    """Attributes the stages and stack samples of the current worker thread to a request's profile."""
+    thread_id = threading.get_ident()
+    _local.profile = profile
+    with _active_profiles_lock:
+        _active_profiles[thread_id] = profile
+    try:
+        yield
+    finally:
+        _local.profile = None
+        with _active_profiles_lock:
+            if _active_profiles.get(thread_id) is profile:
+                del _active_profiles[thread_id]
+
+
+@contextmanager
+def stage(name: str):
+    """Records the duration of a stage of the current request. Does nothing outside of a profiled request."""
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        yield
+        return
+
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.stages.append((name, time.perf_counter() - start_time))
+
+
+def _ensure_sampler() -> None:
+    global _sampler_thread
+    if config.PROFILE_BACKGROUND_SAMPLE_INTERVAL is None and not is_sampling_enabled():
+        return
+    with _sampler_lock:
+        if _sampler_thread is None or not _sampler_thread.is_alive():
+            _sampler_thread = threading.Thread(target=_sample_loop, name='profiler-sampler', daemon=True)
+            _sampler_thread.start()
+
+
+def _sample_loop() -> None:
+    while True:
+        if is_sampling_enabled():
+            interval = config.PROFILE_SAMPLE_INTERVAL
+        elif config.PROFILE_BACKGROUND_SAMPLE_INTERVAL is not None:
+            interval = config.PROFILE_BACKGROUND_SAMPLE_INTERVAL
+        else:
+            # 常時サンプリングが無効で、有効化期間も終わったらスレッドを終了する
+            return
+
+        with _active_profiles_lock:
+            profiles = list(_active_profiles.values())
+        if profiles:
+            frames = sys._current_frames()
+            for profile in profiles:
+                frame = frames.get(profile.thread_id)
+                if frame is not None:
+                    profile.samples[_collapse_stack(frame)] += 1
+
+        time.sleep(interval)
+
+
+def _collapse_stack(frame) -> str:
+    stack = []
+    while frame is not None and len(stack) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+def _write_capture(profile: RequestProfile, total_seconds: float) -> None:
+    global _ring
+    capture = {
+        "response_id": profile.response_id,
+        "started_at": profile.started_at.isoformat(),
+        "total_seconds": round(total_seconds, 4),
+        "slow": total_seconds >= config.SLOW_REQUEST_THRESHOLD,
+        "stages": [{"name": name, "seconds": round(seconds, 4)} for name, seconds in profile.stages],
+        "samples": dict(profile.samples.most_common()),
+    }
+
+    with _ring_lock:
+        if _ring is None:
+            # 再起動後も上限を守れるよう、既存のキャプチャを古い順に読み込んでおく
+            os.makedirs(config.PROFILE_DIR, exist_ok=True)
+            existing = sorted(name for name in os.listdir(config.PROFILE_DIR) if name.endswith('.json'))
+            _ring = deque(existing)
+
+        # ファイル名の先頭をミリ秒のタイムスタンプにして、名前順 = 古い順 になるようにする
+        file_name = f"{int(time.time() * 1000):013d}_{profile.response_id}.json"
+        with open(os.path.join(config.PROFILE_DIR, file_name), 'w', encoding='utf-8') as f:
+            json.dump(capture, f, ensure_ascii=False)
+        _ring.append(file_name)
+
+        while len(_ring) > config.PROFILE_RING_SIZE:
+            oldest = _ring.popleft()
+            try:
+                os.remove(os.path.join(config.PROFILE_DIR, oldest))
+            except FileNotFoundError:
+                pass
+
+    logger.info(f"Profile capture written for {profile.response_id} ({total_seconds:.3f} seconds).")
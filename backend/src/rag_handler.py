@@ -1,25 +1,35 @@
 import re
 import time
 import datetime
+import itertools
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from dotenv import load_dotenv
 
 from google.cloud import aiplatform
+from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import Namespace
 from google import genai
-from google.genai.types import EmbedContentConfig
+from google.genai import errors as genai_errors
+from google.genai.types import EmbedContentConfig, GenerateContentConfig, ThinkingConfig
 from google.cloud.sql.connector import Connector
 
 
-from sqlalchemy import create_engine, select
+from sqlalchemy import create_engine, select, bindparam
 from sqlalchemy.orm import sessionmaker
 
 from src.models.chunk import Chunk
 from src import config
 from src import constants
 from src import prompts
+from src import profiling
+from src import answer_index
 
 from src.exceptions import (
     RetryableRetrievalError,
     NonRetryableRetrievalError,
+    RetrievalCancelledError,
     RetryableGenerationError,
     NonRetryableGenerationError
 )
@@ -41,7 +51,9 @@ CLOUDSQL_USER = config.CLOUDSQL_USER
 CLOUDSQL_PASSWORD = config.CLOUDSQL_PASSWORD
 CLOUDSQL_DATABASE = config.CLOUDSQL_DATABASE
 
-GEMINI_HYDE_MODEL = config.GEMINI_HYDE_MODEL
+GENERATION_PROFILES = config.GENERATION_PROFILES
+STAGE_ROUTES = config.STAGE_ROUTES
+STAGE_LATENCY_BUDGETS = config.STAGE_LATENCY_BUDGETS
 HYDE_PROMPT = prompts.HYDE_PROMPT
 QA_PROMPT = prompts.QA_PROMPT
 GEMINI_EMBEDDING_MODEL = config.GEMINI_EMBEDDING_MODEL
@@ -49,7 +61,7 @@ EMBEDDING_DIMENSIONS = config.EMBEDDING_DIMENSIONS
 
 INDEX_ENDPOINT_NAME=  config.INDEX_ENDPOINT_NAME
 DEPLOYED_INDEX_ID = config.DEPLOYED_INDEX_ID
-GEMINI_QA_MODEL = config.GEMINI_QA_MODEL
+VECTOR_SEARCH_SHARDS = config.VECTOR_SEARCH_SHARDS
 MAX_INPUT = config.MAX_INPUT
 
 # ここのグローバルなスコープで起こるエラーは、起動時エラーであり、そもそもここでエラーが出ると、
@@ -60,18 +72,30 @@ connector = Connector()
 
 # getconn 関数の中では、Cloud SQL ConnectorがIAM認証、SSL/TLS暗号化、安全なトンネルの確立といった
 # 全ての複雑な処理を行い、最終的に標準的なデータベース接続オブジェクトを返します。
-def getconn():
-    conn = connector.connect(
-        # MySQLなどのデータベースサーバーが動作している仮想マシンそのものを一意に識別するための住所
-        INSTANCE_CONNECTION_NAME,
-        "pymysql",
-        user=CLOUDSQL_USER,
-        password=CLOUDSQL_PASSWORD,
-        # INSTANCE_CONNECTION_NAME によって特定される仮想マシンの中には、複数のデータベースが運用
-        # されている可能性があるが、一つのデータベースのみ引数で指定できる。
-        db=CLOUDSQL_DATABASE
-    )
-    return conn
+# 接続貸出の待ち時間から新規接続の確立 (IAM認証・TLS) にかかった時間を除くため、スレッドごとに記録する
+_connect_timing = threading.local()
+
+
+def _make_getconn(instance_connection_name: str):
+    def getconn():
+        start_time = time.perf_counter()
+        try:
+            conn = connector.connect(
+                # MySQLなどのデータベースサーバーが動作している仮想マシンそのものを一意に識別するための住所
+                instance_connection_name,
+                "pymysql",
+                user=CLOUDSQL_USER,
+                password=CLOUDSQL_PASSWORD,
+                # INSTANCE_CONNECTION_NAME によって特定される仮想マシンの中には、複数のデータベースが運用
+                # されている可能性があるが、一つのデータベースのみ引数で指定できる。
+                db=CLOUDSQL_DATABASE
+            )
+        finally:
+            _connect_timing.seconds = getattr(_connect_timing, 'seconds', 0.0) + time.perf_counter() - start_time
+        return conn
+    return getconn
+
+getconn = _make_getconn(INSTANCE_CONNECTION_NAME)
 
 engine = create_engine(
     # creator が指定されている場合、これによって出来上がった接続を受け取って利用する
@@ -85,27 +109,140 @@ engine = create_engine(
 
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 
+# 読み出し専用のリードレプリカ。レプリカごとにプールサイズを設定できるよう、個別のエンジンを作る。
+read_replica_engines = {
+    replica['instance_connection_name']: create_engine(
+        "mysql+pymysql://",
+        creator=_make_getconn(replica['instance_connection_name']),
+        pool_pre_ping=True,
+        pool_recycle=3600,
+        pool_size=replica['pool_size'],
+        max_overflow=replica['max_overflow'],
+        pool_timeout=replica['pool_timeout'],
+    )
+    for replica in config.CLOUDSQL_READ_REPLICAS
+}
+# リクエストごとに最初に試すレプリカをずらして、負荷を均等に分散する
+_replica_round_robin = itertools.count()
+
+# エンジンごとの接続貸出待ち時間の統計 (get_pool_stats で公開する)
+_pool_wait_stats = {
+    name: {"checkouts": 0, "failed_checkouts": 0, "timeouts": 0,
+           "total_wait": 0.0, "max_wait": 0.0, "total_connect": 0.0}
+    for name in [INSTANCE_CONNECTION_NAME, *read_replica_engines]
+}
+_pool_wait_stats_lock = threading.Lock()
+
 aiplatform.init(project=PROJECT_ID, location=LOCATION)
 client = genai.Client(vertexai=True, project=PROJECT_ID, location=LOCATION)
 
+# 複数シャードへの検索を並列に投げるためのスレッドプール。リクエストごとに作らずに使い回す。
+shard_executor = ThreadPoolExecutor(max_workers=config.MAX_SHARD_WORKERS, thread_name_prefix='vector-search')
 
-def _generate_hypothetical_document(user_query: str) -> str:
-    """Generates a hypothetical document from a user query."""
-    start_time = time.time()
 
-    response = client.models.generate_content(
-        model=GEMINI_HYDE_MODEL,
-        contents=HYDE_PROMPT + user_query,
+# プロファイルごとの直近のレイテンシ (指数移動平均, 最終更新時刻)。ルーティングの優先順位づけに使う。
+_profile_latency: dict[str, tuple[float, float]] = {}
+# フォールバック対象のエラーを起こしたプロファイルを、後回しにする期限 (time.monotonic 基準)
+_profile_penalty_until: dict[str, float] = {}
+LATENCY_EWMA_ALPHA = 0.3
+
+
+def _build_generation_config(profile: dict) -> GenerateContentConfig:
+    """Builds the Gemini generation config of a stage profile."""
+    thinking_budget = profile.get('thinking_budget')
+    return GenerateContentConfig(
+        temperature=profile.get('temperature'),
+        max_output_tokens=profile.get('max_output_tokens'),
+        stop_sequences=profile.get('stop_sequences') or None,
+        thinking_config=ThinkingConfig(thinking_budget=thinking_budget) if thinking_budget is not None else None,
     )
-    hypothetical_document = response.text
 
-    logger.info(f"Using model for generating hypothetical document: {GEMINI_HYDE_MODEL}")
-    logger.info(f"Generated hypothetical document: {hypothetical_document}")
 
-    elapsed_time = time.time() - start_time
-    logger.debug(f"generate_hypothetical_document execution time: {elapsed_time:.3f} seconds")
+def _record_profile_latency(profile_name: str, elapsed_time: float) -> None:
+    now = time.monotonic()
+    previous = _profile_latency.get(profile_name)
+    # 古い計測値は捨てて、再び試したときの値で置き換える (過去の遅い呼び出しを引きずらない)
+    if previous is None or now - previous[1] > config.PROFILE_PENALTY_SECONDS:
+        _profile_latency[profile_name] = (elapsed_time, now)
+    else:
+        ewma = LATENCY_EWMA_ALPHA * elapsed_time + (1 - LATENCY_EWMA_ALPHA) * previous[0]
+        _profile_latency[profile_name] = (ewma, now)
+    _profile_penalty_until.pop(profile_name, None)
+
+
+def _record_profile_failure(profile_name: str) -> None:
+    """Demotes a profile that raised a fallback error, until PROFILE_PENALTY_SECONDS have passed."""
+    _profile_penalty_until[profile_name] = time.monotonic() + config.PROFILE_PENALTY_SECONDS
+
+
+def _is_profile_demoted(profile_name: str, budget: float | None, now: float) -> bool:
+    if _profile_penalty_until.get(profile_name, 0.0) > now:
+        return True
+    latency = _profile_latency.get(profile_name)
+    if budget is None or latency is None:
+        return False
+    ewma, updated_at = latency
+    # 予算超過の判定は PROFILE_PENALTY_SECONDS の間だけ有効。期限が過ぎれば先頭に戻して再計測する。
+    return ewma > budget and now - updated_at <= config.PROFILE_PENALTY_SECONDS
+
+
+def _route_profiles(stage: str) -> list[str]:
+    """
+    Returns the profile names to try for a stage.
+
+    Profiles that recently failed or went over the stage's latency budget are moved to the end.
+    The demotion expires after PROFILE_PENALTY_SECONDS, so the profile is tried again first.
+    """
+    route = STAGE_ROUTES[stage]
+    budget = STAGE_LATENCY_BUDGETS.get(stage)
+    now = time.monotonic()
+    preferred = [name for name in route if not _is_profile_demoted(name, budget, now)]
+    demoted = [name for name in route if name not in preferred]
+    return preferred + demoted
+
+
+def _is_fallback_error(e: Exception) -> bool:
+    """Whether an error means the next profile of the route is worth trying (overload, timeout, unavailable model)."""
+    if isinstance(e, (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable,
+                      google_exceptions.DeadlineExceeded, google_exceptions.NotFound)):
+        return True
+    if isinstance(e, genai_errors.ServerError):
+        return True
+    return isinstance(e, genai_errors.ClientError) and e.code in (404, 429)
 
-    return hypothetical_document
+
+def _generate_hypothetical_document(user_query: str) -> str:
+    """Generates a hypothetical document from a user query, falling back along the 'hyde' route."""
+    profile_names = _route_profiles('hyde')
+    for i, profile_name in enumerate(profile_names):
+        profile = GENERATION_PROFILES[profile_name]
+        start_time = time.time()
+
+        try:
+            response = client.models.generate_content(
+                model=profile['model'],
+                contents=HYDE_PROMPT + user_query,
+                config=_build_generation_config(profile),
+            )
+        except Exception as e:
+            if not _is_fallback_error(e):
+                raise
+            _record_profile_failure(profile_name)
+            if i == len(profile_names) - 1:
+                raise
+            logger.warning(f"HyDE generation with profile '{profile_name}' failed, falling back: {e}")
+            continue
+
+        hypothetical_document = response.text or ''
+
+        logger.info(f"Using profile for generating hypothetical document: {profile_name} ({profile['model']})")
+        logger.info(f"Generated hypothetical document: {hypothetical_document}")
+
+        elapsed_time = time.time() - start_time
+        _record_profile_latency(profile_name, elapsed_time)
+        logger.debug(f"generate_hypothetical_document execution time: {elapsed_time:.3f} seconds")
+
+        return hypothetical_document
 
 
 def _split_last_brackets(input_string: str) -> tuple[str, str]:
@@ -136,14 +273,18 @@ def _extract_language(text: str) -> str:
         return constants.ENGLISH
 
 
-def _get_text_embedding(text_to_embed: str) -> list[float]:
+def _get_text_embedding(
+    text_to_embed: str,
+    output_dimensionality: int = EMBEDDING_DIMENSIONS,
+    task_type: str = "RETRIEVAL_QUERY"
+) -> list[float]:
     """Generates a vector embedding for the given text."""
     response = client.models.embed_content(
         model=GEMINI_EMBEDDING_MODEL,
         contents=[text_to_embed],
         config=EmbedContentConfig(
-            task_type="RETRIEVAL_QUERY",
-            output_dimensionality=EMBEDDING_DIMENSIONS,
+            task_type=task_type,
+            output_dimensionality=output_dimensionality,
         ),
     )
     text_embedding = response.embeddings[0].values
@@ -151,30 +292,39 @@ def _get_text_embedding(text_to_embed: str) -> list[float]:
     return text_embedding
 
 
+@lru_cache(maxsize=None)
+def _get_index_endpoint(index_endpoint_id: str) -> aiplatform.MatchingEngineIndexEndpoint:
+    """Returns a cached index endpoint instance (constructing one issues an API call)."""
+    # index_endpoint_id は、数値のIDでも、完全なリソース名
+    # ("projects/.../indexEndpoints/...") のどちらでも可
+    return aiplatform.MatchingEngineIndexEndpoint(
+        index_endpoint_name=index_endpoint_id
+    )
+
+
 def _retrieve_from_vector_search(
     index_endpoint_id: str,
     deployed_index_id: str,
     query_embedding: list[float],
     num_neighbors: int = 4,
-    language: str = 'English'
+    language: str = 'English',
+    restricts: list[Namespace] | None = None
 ) -> list[dict[str, str|float ]]:
     """Retrieves similar document IDs from Vertex AI Vector Search for a given embedding."""
-    logger.info("Starting retrieval from Vertex AI Vector Search.")
+    logger.info(f"Starting retrieval from Vertex AI Vector Search (deployed index: {deployed_index_id}).")
 
-    # 2. インデックスエンドポイントのインスタンスを作成
-    # index_endpoint_id は、数値のIDでも、完全なリソース名
-    # ("projects/.../indexEndpoints/...") のどちらでも可
-    index_endpoint = aiplatform.MatchingEngineIndexEndpoint(
-        index_endpoint_name=index_endpoint_id
-    )
+    # 2. インデックスエンドポイントのインスタンスを取得
+    index_endpoint = _get_index_endpoint(index_endpoint_id)
 
     # 3. find_neighbors メソッドで近傍探索を実行
     # queries引数はベクトルのリストを受け付けるため、単一のクエリでもリストでラップする
+    # restricts を指定すると、その namespace のトークンを持つデータポイントだけが探索対象になる
     response = index_endpoint.find_neighbors(
         queries=[query_embedding],
         deployed_index_id=deployed_index_id,
         num_neighbors=num_neighbors,
-        return_full_datapoint=True
+        return_full_datapoint=True,
+        filter=restricts or None
     )
 
     # 4. 結果を分かりやすい形式に整形
@@ -221,7 +371,167 @@ def _retrieve_from_vector_search(
 
 
 
-def _fetch_records_from_db(datapoints: list[dict[str, str|float]]) -> list[dict|None]:
+def _select_shards(language: str) -> list[dict]:
+    """Returns the shards of the routing table that serve the given language."""
+    return [
+        shard for shard in VECTOR_SEARCH_SHARDS
+        if shard.get('languages') is None or language in shard['languages']
+    ]
+
+
+def _build_restricts(shard: dict, language: str) -> list[Namespace]:
+    """Builds the `restricts` filter of a shard, substituting the detected language."""
+    return [
+        Namespace(name, [token.format(language=language) for token in allow_tokens], [])
+        for name, allow_tokens in shard.get('restricts', {}).items()
+    ]
+
+
+def _retrieve_from_shards(
+    query_embedding: list[float],
+    language: str,
+    num_neighbors: int = 4
+) -> list[dict[str, str|float]]:
+    """
+    Fans the query out to every shard selected for the language and merges the results by distance.
+
+    Note: A datapoint returned by several shards is kept once, with its best distance.
+    """
+    shards = _select_shards(language)
+    if not shards:
+        logger.warning(f"No vector search shard is configured for language: {language}")
+        return []
+
+    def search(shard: dict) -> list[dict[str, str|float]]:
+        return _retrieve_from_vector_search(
+            index_endpoint_id=shard.get('index_endpoint_name', INDEX_ENDPOINT_NAME),
+            deployed_index_id=shard['deployed_index_id'],
+            query_embedding=query_embedding,
+            num_neighbors=shard.get('num_neighbors', num_neighbors),
+            language=language,
+            restricts=_build_restricts(shard, language)
+        )
+
+    # シャードが一つならスレッドを経由せずにそのまま呼ぶ
+    if len(shards) == 1:
+        results_per_shard = [search(shards[0])]
+    else:
+        # map は例外をそのまま呼び出し元に伝播するので、handle_retrieval のエラー処理がそのまま使える
+        results_per_shard = list(shard_executor.map(search, shards))
+
+    merged: dict[str, dict[str, str|float]] = {}
+    for results in results_per_shard:
+        for result in results:
+            existing = merged.get(result["id"])
+            if existing is None or result["distance"] < existing["distance"]:
+                merged[result["id"]] = result
+
+    # 距離は値が小さいほど類似
+    search_results = sorted(merged.values(), key=lambda result: result["distance"])[:num_neighbors]
+    logger.debug(f"Merged {len(search_results)} datapoints from {len(shards)} shard(s).")
+    return search_results
+
+
+# ORM オブジェクトを生成せず、必要なカラムだけを持つ軽量なタプルとして読み出す
+ChunkRow = namedtuple('ChunkRow', ['id', 'content', 'scraped_at'])
+chunk_table = Chunk.__table__
+
+
+@lru_cache(maxsize=32)
+def _select_chunks_stmt(size: int):
+    """Returns a Core SELECT for a fixed IN-list size, so its compiled form is reused across requests."""
+    return select(
+        chunk_table.c.id, chunk_table.c.content, chunk_table.c.scraped_at
+    ).where(
+        chunk_table.c.id.in_([bindparam(f"id_{i}") for i in range(size)])
+    )
+
+
+def _record_pool_wait(name: str, wait: float, connect_time: float, outcome: str) -> None:
+    """Records one checkout attempt. outcome is 'ok', 'timeout' (pool exhausted) or 'failed'."""
+    with _pool_wait_stats_lock:
+        stats = _pool_wait_stats[name]
+        if outcome == 'ok':
+            stats["checkouts"] += 1
+        else:
+            stats["failed_checkouts"] += 1
+            if outcome == 'timeout':
+                stats["timeouts"] += 1
+        stats["total_wait"] += wait
+        stats["max_wait"] = max(stats["max_wait"], wait)
+        stats["total_connect"] += connect_time
+
+
+def get_pool_stats() -> dict[str, dict]:
+    """Returns the pool status and connection checkout wait times of the primary and each read replica."""
+    engines = {INSTANCE_CONNECTION_NAME: engine, **read_replica_engines}
+    pool_stats = {}
+    with _pool_wait_stats_lock:
+        for name, stats in _pool_wait_stats.items():
+            # 待ち時間は失敗・タイムアウトした貸出も含めた平均 (新規接続の確立時間は除く)
+            attempts = stats["checkouts"] + stats["failed_checkouts"]
+            pool_stats[name] = {
+                "role": "primary" if name == INSTANCE_CONNECTION_NAME else "replica",
+                "pool": engines[name].pool.status(),
+                "checkouts": stats["checkouts"],
+                "failed_checkouts": stats["failed_checkouts"],
+                "timeouts": stats["timeouts"],
+                "avg_wait": stats["total_wait"] / attempts if attempts else 0.0,
+                "max_wait": stats["max_wait"],
+                "total_connect": stats["total_connect"],
+            }
+    return pool_stats
+
+
+def _execute_read(stmt, params: dict, use_replicas: bool = True) -> list:
+    """
+    Executes a read-only statement on a read replica, failing over to the next replica and finally the primary.
+
+    Args:
+        use_replicas: If False, the statement runs on the primary only (e.g. for rows that a lagging replica lacks).
+
+    Raises:
+        sqlalchemy_exceptions.OperationalError / TimeoutError: If the primary also fails.
+    """
+    replica_names = list(read_replica_engines) if use_replicas else []
+    if replica_names:
+        offset = next(_replica_round_robin) % len(replica_names)
+        replica_names = replica_names[offset:] + replica_names[:offset]
+
+    candidates = [(name, read_replica_engines[name]) for name in replica_names]
+    candidates.append((INSTANCE_CONNECTION_NAME, engine))
+
+    for i, (name, candidate_engine) in enumerate(candidates):
+        is_last = i == len(candidates) - 1
+        try:
+            conn = _checkout(name, candidate_engine)
+            with conn:
+                return conn.execute(stmt, params).all()
+        except (sqlalchemy_exceptions.OperationalError, sqlalchemy_exceptions.TimeoutError) as e:
+            if is_last:
+                raise
+            logger.warning(f"Read from {name} failed, failing over to the next database: {e}")
+
+
+def _checkout(name: str, candidate_engine):
+    """Checks a connection out of the engine's pool, recording the wait whether it succeeds, fails or times out."""
+    _connect_timing.seconds = 0.0
+    outcome = 'failed'
+    start_time = time.perf_counter()
+    try:
+        conn = candidate_engine.connect()
+        outcome = 'ok'
+        return conn
+    except sqlalchemy_exceptions.TimeoutError:
+        outcome = 'timeout'
+        raise
+    finally:
+        elapsed_time = time.perf_counter() - start_time
+        connect_time = min(_connect_timing.seconds, elapsed_time)
+        _record_pool_wait(name, elapsed_time - connect_time, connect_time, outcome)
+
+
+def _fetch_records_from_db(datapoints: list[dict[str, str|float]]) -> list[ChunkRow]:
     """
     Fetches document records from the Cloud SQL database based on a list of search result IDs.
 
@@ -235,17 +545,26 @@ def _fetch_records_from_db(datapoints: list[dict[str, str|float]]) -> list[dict|
         logger.warning("No valid IDs found in datapoints. Returning an empty list.")
         return []
 
-    # SQLAlchemy の select を使ってクエリを構築
-    stmt = select(Chunk).where(Chunk.id.in_(id_list))
-    # SessionLocal() 自体が context manager なので with で閉じられる
-    with SessionLocal() as session:
-        # 構築した select 文 (stmt) を実行する
-        # パラメータは select 文に含まれているため、ここでは渡す必要がない
-        records = session.execute(stmt).scalars().all()
+    # IN リストの件数ごとにキャッシュされた Core の select 文を使い、必要なカラムだけを読み出す
+    stmt = _select_chunks_stmt(len(id_list))
+    params = {f"id_{i}": id for i, id in enumerate(id_list)}
+    records = [ChunkRow(*row) for row in _execute_read(stmt, params)]
 
     # 結果を datapoints の順に整列させるため、IDをキーにした辞書を作成します
     records_with_id_key = {record.id: record for record in records}
 
+    # リードレプリカはレプリケーション遅延で、取り込まれたばかりのチャンクをまだ持っていないことがある。
+    # 見つからなかった ID は、欠落として扱う前にプライマリで読み直す。
+    missing_ids = [id for id in id_list if id not in records_with_id_key]
+    if missing_ids and read_replica_engines:
+        logger.info(f"{len(missing_ids)} chunk(s) not found on the read replica. Re-reading them from the primary.")
+        missing_params = {f"id_{i}": id for i, id in enumerate(missing_ids)}
+        primary_rows = _execute_read(_select_chunks_stmt(len(missing_ids)), missing_params, use_replicas=False)
+        for row in primary_rows:
+            record = ChunkRow(*row)
+            records.append(record)
+            records_with_id_key[record.id] = record
+
     # 元のIDリストの順序に従って、レコードのリストを再構築します
     ordered_records = []
     for id in id_list:
@@ -259,6 +578,47 @@ def _fetch_records_from_db(datapoints: list[dict[str, str|float]]) -> list[dict|
     return ordered_records
 
 
+# チャンク本文末尾の [SOURCE] / [CATEGORY] 行を毎リクエスト正規表現で解析しないよう、
+# (id, scraped_at) をキーにして解析結果をキャッシュする。scraped_at が変われば本文も
+# 再スクレイプされているので、自動的に新しいキーとして解析し直される。
+_SOURCE_PATTERN = re.compile(r"^\[SOURCE\]:\s*(\S+)\s*$", re.MULTILINE)
+_CATEGORY_PATTERN = re.compile(r"^\[CATEGORY\]:\s*(.+?)\s*$", re.MULTILINE)
+_TITLE_PATTERN = re.compile(r"^#\s+(.+?)\s*$", re.MULTILINE)
+
+_chunk_metadata_cache: dict[tuple[str, datetime.datetime], dict[str, str|None]] = {}
+MAX_CHUNK_METADATA_CACHE = 10000
+
+
+def _parse_chunk_metadata(chunk) -> dict[str, str|None]:
+    """Extracts title, source URL, category and scraped_at of a chunk, cached per chunk version."""
+    cache_key = (chunk.id, chunk.scraped_at)
+    metadata = _chunk_metadata_cache.get(cache_key)
+    if metadata is not None:
+        return metadata
+
+    source_match = _SOURCE_PATTERN.search(chunk.content)
+    category_match = _CATEGORY_PATTERN.search(chunk.content)
+    title_match = _TITLE_PATTERN.search(chunk.content)
+    metadata = {
+        "id": chunk.id,
+        "title": title_match.group(1) if title_match else None,
+        "url": source_match.group(1) if source_match else None,
+        "category": category_match.group(1) if category_match else None,
+        "scraped_at": chunk.scraped_at.strftime("%Y/%m/%d %H:%M"),
+    }
+
+    # 古いバージョンのチャンクが溜まり続けないよう、上限に達したら一度クリアする
+    if len(_chunk_metadata_cache) >= MAX_CHUNK_METADATA_CACHE:
+        _chunk_metadata_cache.clear()
+    _chunk_metadata_cache[cache_key] = metadata
+    return metadata
+
+
+def _make_sources(chunk_records: list) -> list[dict[str, str|None]]:
+    """Builds the list of source metadata for the retrieved chunks, in retrieval order."""
+    return [_parse_chunk_metadata(chunk) for chunk in chunk_records if chunk is not None]
+
+
 def _make_final_context(chunk_records: list) -> str:
     documents = []
     for chunk in chunk_records:
@@ -274,19 +634,28 @@ def _make_final_context(chunk_records: list) -> str:
     return final_context
 
 
-def handle_retrieval(user_query: str) -> tuple[str, str]:
+def _check_cancelled(cancel_event: threading.Event | None) -> None:
+    if cancel_event is not None and cancel_event.is_set():
+        raise RetrievalCancelledError("Retrieval was cancelled because its result is no longer needed.")
+
+
+def handle_retrieval(user_query: str, cancel_event: threading.Event | None = None) -> tuple[str, str, list[dict[str, str|None]]]:
     """
     Orchestrates the RAG document retrieval pipeline.
 
     Args:
         user_query: The raw input string from the user.
+        cancel_event: If set while the pipeline runs, it stops before the next stage
+            (a stage already in progress is not interrupted).
 
     Returns:
-        A tuple containing the concatenated document chunks and the detected language.
+        A tuple containing the concatenated document chunks, the detected language,
+        and the source metadata (id, title, url, category, scraped_at) of each chunk.
 
     Raises:
         RetryableRetrievalError: For temporary issues where a retry might succeed.
         NonRetryableRetrievalError: For permanent issues where a retry would fail.
+        RetrievalCancelledError: If cancel_event was set.
     """
     try:
         if not user_query or not user_query.strip():
@@ -296,33 +665,40 @@ def handle_retrieval(user_query: str) -> tuple[str, str]:
             logger.info(f"Input length exceeded {MAX_INPUT} characters. Truncating the input.")
             user_query = user_query[:MAX_INPUT]
 
-        hypothetical_document = _generate_hypothetical_document(user_query)
+        with profiling.stage('hyde'):
+            hypothetical_document = _generate_hypothetical_document(user_query)
         hypothetical_document, bracket_part = _split_last_brackets(hypothetical_document)
         language = _extract_language(bracket_part)
-        hyde_embedding = _get_text_embedding(hypothetical_document)
-        search_results = _retrieve_from_vector_search(
-            index_endpoint_id=INDEX_ENDPOINT_NAME,
-            deployed_index_id=DEPLOYED_INDEX_ID,
-            query_embedding=hyde_embedding,
-            num_neighbors=config.K
-        )
+        _check_cancelled(cancel_event)
+        with profiling.stage('embedding'):
+            hyde_embedding = _get_text_embedding(hypothetical_document)
+        _check_cancelled(cancel_event)
+        with profiling.stage('vector_search'):
+            search_results = _retrieve_from_shards(
+                query_embedding=hyde_embedding,
+                language=language,
+                num_neighbors=config.K
+            )
         if not search_results:
             logger.info("No relevant datapoints found for the user's query.")
             raise NonRetryableRetrievalError("No relevant datapoints found for the question.")
 
-        chunk_records = _fetch_records_from_db(search_results)
+        _check_cancelled(cancel_event)
+        with profiling.stage('db_fetch'):
+            chunk_records = _fetch_records_from_db(search_results)
 
         if not chunk_records:
             logger.error("No chunks found from datapoint ids.")
             raise NonRetryableRetrievalError("No chunks were found from datapoint ids.")
 
         final_context = _make_final_context(chunk_records)
+        sources = _make_sources(chunk_records)
 
-        return final_context, language
+        return final_context, language, sources
 
     # --- Exception Handling ---
 
-    except (RetryableRetrievalError, NonRetryableRetrievalError):
+    except (RetryableRetrievalError, NonRetryableRetrievalError, RetrievalCancelledError):
         raise
 
     # [Retryable] API rate limits or temporary server errors.
@@ -330,8 +706,8 @@ def handle_retrieval(user_query: str) -> tuple[str, str]:
         logger.warning(f"A retryable API error occurred: {e}", exc_info=True)
         raise RetryableRetrievalError("Access to the external API is temporarily unavailable due to high traffic.") from e
 
-    # [Retryable] Temporary database connection errors.
-    except sqlalchemy_exceptions.OperationalError as e:
+    # [Retryable] Temporary database connection errors (including connection pool exhaustion).
+    except (sqlalchemy_exceptions.OperationalError, sqlalchemy_exceptions.TimeoutError) as e:
         logger.warning(f"A retryable database error occurred: {e}", exc_info=True)
         raise RetryableRetrievalError("The connection to the database was temporarily lost.") from e
 
@@ -357,6 +733,130 @@ def handle_retrieval(user_query: str) -> tuple[str, str]:
         raise NonRetryableRetrievalError("An unexpected error occurred during the search.") from e
 
 
+def _to_generation_error(e: Exception) -> Exception:
+    """Maps an error raised while generating the answer to RetryableGenerationError or NonRetryableGenerationError."""
+    # google-genai は HTTP ステータス付きの独自の例外を送出するので、google.api_core の例外と同じ分類に揃える
+    code = getattr(e, 'code', None) if isinstance(e, genai_errors.APIError) else None
+
+    # [Retryable] API rate limits or temporary server errors.
+    if (isinstance(e, (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded))
+            or isinstance(e, genai_errors.ServerError) or code == 429):
+        logger.warning(f"A retryable LLM generation error occurred: {e}", exc_info=True)
+        return RetryableGenerationError("The response generation service is temporarily unavailable due to high traffic.")
+
+    # [Non-Retryable] Authentication/permission errors.
+    if isinstance(e, google_exceptions.PermissionDenied) or code in (401, 403):
+        logger.error(f"A non-retryable LLM permission error occurred: {e}", exc_info=True)
+        return NonRetryableGenerationError("Permission denied for the response generation service.")
+
+    # [Non-Retryable] Invalid request, e.g., oversized prompt or content policy violation.
+    if isinstance(e, (google_exceptions.InvalidArgument, google_exceptions.FailedPrecondition)) or code == 400:
+        logger.error(f"A non-retryable LLM invalid request error occurred: {e}", exc_info=True)
+        return NonRetryableGenerationError("The request is invalid or may have violated the content policy.")
+
+    # [Non-Retryable] Catch-all for any other unexpected errors.
+    logger.error(f"An unexpected error occurred during stream generation: {e}", exc_info=True)
+    return NonRetryableGenerationError("An unexpected error occurred while generating the response.")
+
+
+def _stream_with_fallback(stage: str, contents: str):
+    """
+    Streams a response along the stage's route.
+
+    Falls back to the next profile only if the current one fails before its first chunk,
+    so a partially sent answer is never mixed with another model's answer.
+
+    This is a generator, so it runs only when the caller iterates it, after get_stream has
+    returned. Errors are therefore translated here, during iteration, as well.
+
+    Raises:
+        RetryableGenerationError: For temporary API issues where a retry might succeed.
+        NonRetryableGenerationError: For permanent errors where a retry would fail.
+    """
+    try:
+        profile_names = _route_profiles(stage)
+        for i, profile_name in enumerate(profile_names):
+            profile = GENERATION_PROFILES[profile_name]
+            start_time = time.time()
+
+            try:
+                stream = client.models.generate_content_stream(
+                    model=profile['model'],
+                    contents=contents,
+                    config=_build_generation_config(profile),
+                )
+                first_chunk = next(stream, None)
+            except Exception as e:
+                if not _is_fallback_error(e):
+                    raise
+                _record_profile_failure(profile_name)
+                if i == len(profile_names) - 1:
+                    raise
+                logger.warning(f"QA generation with profile '{profile_name}' failed, falling back: {e}")
+                continue
+
+            elapsed_time = time.time() - start_time
+            _record_profile_latency(profile_name, elapsed_time)
+            logger.info(f"Using profile for final QA generation: {profile_name} ({profile['model']})")
+            logger.debug(f"Final QA time to first chunk: {elapsed_time:.3f} seconds")
+
+            if first_chunk is not None:
+                yield first_chunk
+            yield from stream
+            return
+
+    except (RetryableGenerationError, NonRetryableGenerationError):
+        raise
+
+    except Exception as e:
+        raise _to_generation_error(e) from e
+
+
+def find_precomputed_answer(user_query: str, use_embedding: bool = False) -> dict | None:
+    """
+    Looks the question up in the offline answer index.
+
+    With use_embedding=False only an exact (normalized) match is tried, which needs no API call.
+    With use_embedding=True, one embedding call is made to find a near-identical question; the
+    caller runs this concurrently with handle_retrieval (cancelling it on a hit) so an index
+    miss adds no latency.
+    Any failure returns None so the regular pipeline answers instead.
+
+    Returns:
+        The index entry (query, answer, language, sources, chunk_versions), or None.
+    """
+    try:
+        index = answer_index.get_index()
+        if index is None or not user_query or not user_query.strip():
+            return None
+
+        if use_embedding:
+            query_embedding = _get_text_embedding(
+                user_query[:MAX_INPUT],
+                output_dimensionality=EMBEDDING_DIMENSIONS,
+                task_type=answer_index.QUERY_EMBEDDING_TASK_TYPE
+            )
+            entry = index.lookup_embedding(query_embedding, user_query[:MAX_INPUT])
+        else:
+            entry = index.lookup_text(user_query[:MAX_INPUT])
+
+        if entry is not None:
+            logger.info(f"Answering from the precomputed answer index: {entry['query']}")
+        return entry
+
+    except Exception as e:
+        logger.warning(f"Answer index lookup failed, falling back to the RAG pipeline: {e}", exc_info=True)
+        return None
+
+
+def can_lookup_by_embedding(user_query: str) -> bool:
+    """
+    Whether an embedding lookup could match: an answer index is available and the question's
+    language is known from its script. Otherwise the embedding call would be wasted.
+    """
+    return answer_index.get_index() is not None and answer_index.detect_language(user_query or '') is not None
+
+
 def get_stream(inputText: str, docs: str, language: str):
     """
     Generates a response stream from the LLM using the provided context.
@@ -367,7 +867,8 @@ def get_stream(inputText: str, docs: str, language: str):
         language (str): The target language for the LLM's response.
 
     Returns:
-        A stream of response chunks from the language model.
+        A stream of response chunks from the language model. The request to the model starts
+        when the stream is first iterated, so the errors below may also be raised while iterating.
 
     Raises:
         RetryableGenerationError: For temporary API issues where a retry might succeed.
@@ -378,40 +879,17 @@ def get_stream(inputText: str, docs: str, language: str):
         qa_base_prompt = qa_template.format(language=language, context=docs) + " Here's the question: "
         logger.debug(qa_base_prompt)
 
-        start_time = time.time()
-
-        logger.info(f"Using model for final QA generation: {GEMINI_QA_MODEL}")
-        stream = client.models.generate_content_stream(model=GEMINI_QA_MODEL, contents=qa_base_prompt + inputText)
-
-        elapsed_time = time.time() - start_time
-
-        logger.debug(f"Final QA generation time: {elapsed_time:.3f} seconds")
-
+        # 短い質問は思考なしの軽いプロファイルで十分に答えられる
+        stage = 'qa_short' if len(inputText) <= config.SHORT_QUESTION_MAX_CHARS else 'qa'
+        stream = _stream_with_fallback(stage, qa_base_prompt + inputText)
 
         return stream
 
-    # [Retryable] API rate limits or temporary server errors.
     except (RetryableGenerationError, NonRetryableGenerationError):
         raise
 
-    except (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded) as e:
-        logger.warning(f"A retryable LLM generation error occurred: {e}", exc_info=True)
-        raise RetryableGenerationError("The response generation service is temporarily unavailable due to high traffic.") from e
-
-    # [Non-Retryable] Authentication/permission errors.
-    except google_exceptions.PermissionDenied as e:
-        logger.error(f"A non-retryable LLM permission error occurred: {e}", exc_info=True)
-        raise NonRetryableGenerationError("Permission denied for the response generation service.") from e
-
-    # [Non-Retryable] Invalid request, e.g., oversized prompt or content policy violation.
-    except (google_exceptions.InvalidArgument, google_exceptions.FailedPrecondition) as e:
-        logger.error(f"A non-retryable LLM invalid request error occurred: {e}", exc_info=True)
-        raise NonRetryableGenerationError("The request is invalid or may have violated the content policy.") from e
-
-    # [Non-Retryable] Catch-all for any other unexpected errors.
     except Exception as e:
-        logger.error(f"An unexpected error occurred during stream generation: {e}", exc_info=True)
-        raise NonRetryableGenerationError("An unexpected error occurred while generating the response.") from e
+        raise _to_generation_error(e) from e
 
 
 """
@@ -1,10 +1,19 @@
 import os
+import hmac
 from uuid import uuid4
 import json
-from flask import Flask
+import logging
+import datetime
+import itertools
+import threading
+from concurrent.futures import Future
+from flask import Flask, request, jsonify, abort
 from flask_sock import Sock
 from google import genai
-from rag_handler import handle_retrieval, get_stream
+from rag_handler import handle_retrieval, get_stream, get_pool_stats, find_precomputed_answer, can_lookup_by_embedding
+from src import config
+from src import profiling
+from src.exceptions import RetrievalError
 
 # --- 初期設定 ---
 
@@ -14,9 +23,75 @@ sock = Sock(app)
 
 client = genai.Client(vertexai=True, project='arvato-developments', location='us-central1')
 
+# 質問ログ (回答インデックスのバッチが、よくある質問を集計するために読む)
+query_logger = logging.getLogger('src.query_log')
+
 
 # --- WebSocketのエンドポイント定義 ---
 
+def _start_thread(name, profile, fn, *args) -> Future:
+    """
+    fn をこのリクエスト専用のスレッドで実行し、結果を Future で返す。
+    共有のスレッドプールを使わないので、同時リクエストが多くても他のリクエストの後ろで待たされない。
+    (Werkzeug も接続ごとにスレッドを立てるので、スレッド数はもともと接続数に比例する)
+    スレッドでのステージとスタックのサンプルは、同じリクエストのプロファイルに記録する。
+    """
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            with profiling.bind(profile):
+                future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name=name, daemon=True).start()
+    return future
+
+
+def _lookup_by_embedding(message, cancel_event):
+    with profiling.stage('answer_index_embedding'):
+        precomputed = find_precomputed_answer(message, use_embedding=True)
+    if precomputed is not None:
+        # 検索の結果は使わないので、次のステージに進む前に止めさせる
+        cancel_event.set()
+    return precomputed
+
+
+def _find_precomputed_or_retrieve(message, profile):
+    """
+    回答インデックスにヒットすれば (エントリ, None)、しなければ (None, handle_retrieval の結果) を返す。
+    完全一致の照合は API を呼ばないので先に行う。埋め込みでの照合は埋め込み API を1回呼ぶため、
+    このリクエスト専用のスレッドで検索と並行して行い、ヒットしなかった大多数のリクエストを遅らせないようにする。
+    検索はこのスレッドで行い、照合がヒットした時点で打ち切る。
+    """
+    with profiling.stage('answer_index'):
+        precomputed = find_precomputed_answer(message)
+    if precomputed is not None:
+        return precomputed, None
+
+    if not (config.ANSWER_INDEX_EMBEDDING_LOOKUP and can_lookup_by_embedding(message)):
+        return None, handle_retrieval(message)
+
+    cancel_event = threading.Event()
+    lookup_future = _start_thread('answer-index-lookup', profile, _lookup_by_embedding, message, cancel_event)
+    try:
+        retrieval = handle_retrieval(message, cancel_event=cancel_event)
+    except RetrievalError:
+        # 打ち切られた場合に加え、検索が失敗しても照合がヒットしていれば事前計算済みの回答を返す
+        precomputed = lookup_future.result()
+        if precomputed is None:
+            raise
+        return precomputed, None
+
+    precomputed = lookup_future.result()
+    if precomputed is not None:
+        return precomputed, None
+    return None, retrieval
+
+
 @sock.route('/ws')
 def websocket_connection(ws):
     """
@@ -32,23 +107,68 @@ def websocket_connection(ws):
                 # 接続が閉じた場合
                 break
 
-            final_context, language = handle_retrieval(message)
-            stream = get_stream(inputText = message, docs = final_context, language = language)
-
             # この一連のやり取りにユニークなIDを付与
             response_id = str(uuid4())
             print(f"リクエスト受信 (ID: {response_id}): {message}")
 
-            # handleQuestionジェネレータを使って、ストリーミング応答を送信
-            for chunk in stream:
-                response_data = {
-                    "id": response_id,
-                    "chunk": chunk,
-                    "isFinal": False
-                }
-                ws.send(json.dumps(response_data))
+            query_logger.info(json.dumps({
+                "at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "query": message
+            }, ensure_ascii=False))
+
+            # ステージごとの所要時間を記録し、遅いリクエストは response_id をキーにディスクへ保存する
+            profile = profiling.start_request(response_id)
+            try:
+                # よくある質問は、オフラインで事前計算した回答をそのまま返す (Gemini での生成を行わない)
+                precomputed, retrieval = _find_precomputed_or_retrieve(message, profile)
+                if precomputed is not None:
+                    ws.send(json.dumps({
+                        "id": response_id,
+                        "type": "sources",
+                        "language": precomputed["language"],
+                        "sources": precomputed["sources"]
+                    }))
+                    ws.send(json.dumps({"id": response_id, "chunk": precomputed["answer"], "isFinal": False}))
+                    ws.send(json.dumps({"id": response_id, "chunk": '', "isFinal": False}))
+                    continue
+
+                final_context, language, sources = retrieval
+                stream = get_stream(inputText = message, docs = final_context, language = language)
 
-            ws.send(json.dumps({"id": response_id, "chunk": '', "isFinal": False}))
+                # get_stream は遅延評価なので、別スレッドで最初のチャンクの取得を始めて Gemini へのリクエストを先に走らせる
+                first_chunk_future = _start_thread('qa-prefetch', profile, next, stream, None)
+
+                try:
+                    # 最初のトークンを待たずに、検索が終わった時点で情報ソースを送信する。
+                    # フロントエンドはこのフレームで SidePanel を即座に埋めることができる。
+                    ws.send(json.dumps({
+                        "id": response_id,
+                        "type": "sources",
+                        "language": language,
+                        "sources": sources
+                    }))
+
+                    # handleQuestionジェネレータを使って、ストリーミング応答を送信
+                    with profiling.stage('qa_stream'):
+                        # 最初のチャンク取得中の例外は result() でこのスレッドに再送出される
+                        first_chunk = first_chunk_future.result()
+                        head = [first_chunk] if first_chunk is not None else []
+                        for chunk in itertools.chain(head, stream):
+                            response_data = {
+                                "id": response_id,
+                                "chunk": chunk,
+                                "isFinal": False
+                            }
+                            ws.send(json.dumps(response_data))
+                except BaseException:
+                    # 送信に失敗した場合 (切断など) は、最初のチャンクの取得が終わり次第ストリームを閉じて
+                    # Gemini への接続を解放する (取得中のジェネレータはその場では閉じられない)
+                    first_chunk_future.add_done_callback(lambda _: stream.close())
+                    raise
+
+                ws.send(json.dumps({"id": response_id, "chunk": '', "isFinal": False}))
+            finally:
+                profiling.finish_request(profile)
 
     except Exception as e:
         print(f"WebSocketエラー: {e}")
@@ -56,6 +176,40 @@ def websocket_connection(ws):
         print("クライアントが切断しました。")
 
 
+# --- 管理用エンドポイント ---
+
+def _require_admin():
+    """ADMIN_TOKEN が未設定、またはヘッダーのトークンが一致しない場合はリクエストを拒否する。"""
+    # 一致するまでの比較時間からトークンを推測されないよう、定数時間で比較する
+    if not config.ADMIN_TOKEN or not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), config.ADMIN_TOKEN):
+        abort(403)
+
+
+@app.get('/admin/db-pool')
+def db_pool_stats():
+    """プライマリと各リードレプリカの接続プール状態と、接続貸出の待ち時間を返す。"""
+    _require_admin()
+    return jsonify(get_pool_stats())
+
+
+@app.route('/admin/profiling', methods=['GET', 'POST'])
+def profiling_control():
+    """
+    GET: プロファイラの状態を返す。
+    POST: {"seconds": N} で N 秒間、高頻度のスタックサンプリングを有効にする。
+    有効な間に処理されたリクエストは、処理時間に関係なく全て保存される。
+    """
+    _require_admin()
+    if request.method == 'POST':
+        payload = request.get_json(silent=True) or {}
+        try:
+            seconds = float(payload.get('seconds', request.args.get('seconds', 60)))
+        except (TypeError, ValueError):
+            abort(400)
+        profiling.enable_sampling(seconds)
+    return jsonify(profiling.get_status())
+
+
 # --- Flaskサーバーの起動 ---
 
 if __name__ == '__main__':